@@ -0,0 +1,260 @@
+import json
+import math
+import time
+import argparse
+import boto3
+from botocore.exceptions import BotoCoreError, ClientError
+from concurrent.futures import ThreadPoolExecutor
+
+# must match SAGEMAKER_ENDPOINT_NAME in endpoint_handler.py, the endpoint config created by deploy shares the name
+ENDPOINT_NAME = "huggingface-pytorch-sagemaker-endpoint"
+VARIANT_NAME = "AllTraffic"  # the single variant HuggingFaceModel.deploy creates
+SCALABLE_DIMENSION = "sagemaker:variant:DesiredInstanceCount"
+
+# target tracking on SageMakerVariantInvocationsPerInstance, which is measured per minute
+TARGET_INVOCATIONS_PER_INSTANCE = 20
+SCALE_OUT_COOLDOWN_SECONDS = 300
+SCALE_IN_COOLDOWN_SECONDS = 900
+
+# off hours schedule, scale down at the first hour and back up at the second, on weekdays only (UTC). The scale down on
+# friday evening therefore holds until monday morning
+OFF_HOURS = (20, 8)
+
+WARM_UP_PROMPT = "Hello"
+WARM_UP_REQUESTS_PER_INSTANCE = 3  # requests are routed at random, send a few per instance so each one sees traffic
+
+
+def get_resource_id(endpoint_name=ENDPOINT_NAME, variant_name=VARIANT_NAME):
+    return f"endpoint/{endpoint_name}/variant/{variant_name}"
+
+
+def weekday_schedule(hour):
+    # application auto scaling cron expressions are in UTC
+    return f"cron(0 {hour} ? * MON-FRI *)"
+
+
+# Scale the endpoint between min and max instances to keep invocations per instance near the target
+def configure_autoscaling(endpoint_name=ENDPOINT_NAME, min_instance_count=1, max_instance_count=2,
+                          target_invocations_per_instance=TARGET_INVOCATIONS_PER_INSTANCE,
+                          scale_out_cooldown=SCALE_OUT_COOLDOWN_SECONDS, scale_in_cooldown=SCALE_IN_COOLDOWN_SECONDS):
+    autoscaling_client = boto3.client('application-autoscaling')
+    resource_id = get_resource_id(endpoint_name)
+
+    autoscaling_client.register_scalable_target(
+        ServiceNamespace='sagemaker',
+        ResourceId=resource_id,
+        ScalableDimension=SCALABLE_DIMENSION,
+        MinCapacity=min_instance_count,
+        MaxCapacity=max_instance_count
+    )
+    autoscaling_client.put_scaling_policy(
+        PolicyName=f"{endpoint_name}-invocations-target-tracking",
+        ServiceNamespace='sagemaker',
+        ResourceId=resource_id,
+        ScalableDimension=SCALABLE_DIMENSION,
+        PolicyType='TargetTrackingScaling',
+        TargetTrackingScalingPolicyConfiguration={
+            'TargetValue': float(target_invocations_per_instance),
+            'PredefinedMetricSpecification': {
+                'PredefinedMetricType': 'SageMakerVariantInvocationsPerInstance'
+            },
+            'ScaleOutCooldown': scale_out_cooldown,
+            'ScaleInCooldown': scale_in_cooldown
+        }
+    )
+    print(f"Autoscaling {endpoint_name} between {min_instance_count} and {max_instance_count} instances "
+          f"at {target_invocations_per_instance} invocations per instance per minute")
+
+
+# Cap the endpoint at off_hours_max_instance_count outside working hours, then restore the normal range
+def schedule_scale_down(endpoint_name=ENDPOINT_NAME, min_instance_count=1, max_instance_count=2, off_hours_max_instance_count=1,
+                        off_hours=OFF_HOURS):
+    autoscaling_client = boto3.client('application-autoscaling')
+    resource_id = get_resource_id(endpoint_name)
+    scale_down_schedule, scale_up_schedule = weekday_schedule(off_hours[0]), weekday_schedule(off_hours[1])
+
+    for action_name, schedule, action in [
+        (f"{endpoint_name}-scale-down", scale_down_schedule, {'MinCapacity': 1, 'MaxCapacity': off_hours_max_instance_count}),
+        (f"{endpoint_name}-scale-up", scale_up_schedule, {'MinCapacity': min_instance_count, 'MaxCapacity': max_instance_count}),
+    ]:
+        autoscaling_client.put_scheduled_action(
+            ServiceNamespace='sagemaker',
+            ScheduledActionName=action_name,
+            ResourceId=resource_id,
+            ScalableDimension=SCALABLE_DIMENSION,
+            Schedule=schedule,
+            ScalableTargetAction=action
+        )
+    print(f"Scheduled {endpoint_name} to scale down at {scale_down_schedule} and back up at {scale_up_schedule}")
+
+
+# Real time endpoint variants cannot run zero instances, so scaling to zero deletes the endpoint and keeps its config.
+# This is a manual action, nothing recreates the endpoint when traffic returns and until scale_from_zero runs the bot
+# answers every question with its out of domain response
+def scale_to_zero(endpoint_name=ENDPOINT_NAME):
+    autoscaling_client = boto3.client('application-autoscaling')
+    sagemaker_client = boto3.client('sagemaker')
+    try:
+        autoscaling_client.deregister_scalable_target(
+            ServiceNamespace='sagemaker',
+            ResourceId=get_resource_id(endpoint_name),
+            ScalableDimension=SCALABLE_DIMENSION
+        )
+    except ClientError:
+        pass  # autoscaling was never configured
+    sagemaker_client.delete_endpoint(EndpointName=endpoint_name)
+    print(f"Endpoint {endpoint_name} deleted, endpoint config {endpoint_name} kept for scale_from_zero")
+
+
+# Recreate the endpoint from its kept config and warm it up before returning
+def scale_from_zero(endpoint_name=ENDPOINT_NAME, min_instance_count=1, max_instance_count=1):
+    sagemaker_client = boto3.client('sagemaker')
+    sagemaker_client.create_endpoint(EndpointName=endpoint_name, EndpointConfigName=endpoint_name)
+    print(f"Recreating endpoint {endpoint_name}, waiting for it to be in service...")
+    sagemaker_client.get_waiter('endpoint_in_service').wait(
+        EndpointName=endpoint_name,
+        WaiterConfig={'Delay': 30, 'MaxAttempts': 60}
+    )
+    warm_up(endpoint_name)
+    if max_instance_count > 1:
+        configure_autoscaling(endpoint_name, min_instance_count, max_instance_count)
+
+
+# Send a few short requests per instance so model weights and kernels are loaded before real traffic needs them.
+# Failures are only printed, warm up runs right after deploy and must never fail it
+def warm_up(endpoint_name=ENDPOINT_NAME, requests_per_instance=WARM_UP_REQUESTS_PER_INSTANCE):
+    sagemaker_client = boto3.client('sagemaker')
+    runtime_client = boto3.client('sagemaker-runtime')
+    try:
+        endpoint = sagemaker_client.describe_endpoint(EndpointName=endpoint_name)
+    except (ClientError, BotoCoreError) as e:
+        print(f"Skipping warm up of {endpoint_name}: {e}")
+        return
+    instance_count = endpoint['ProductionVariants'][0].get('CurrentInstanceCount', 1)
+
+    payload = json.dumps({"inputs": WARM_UP_PROMPT, "parameters": {"max_new_tokens": 8}})
+    def invoke(_):
+        try:
+            runtime_client.invoke_endpoint(EndpointName=endpoint_name, ContentType="application/json", Body=payload)
+            return True
+        except (ClientError, BotoCoreError) as e:
+            # the first generation can outlast the read timeout, which is a BotoCoreError
+            print(e)
+            return False
+
+    request_count = instance_count * requests_per_instance
+    with ThreadPoolExecutor(max_workers=request_count) as executor:
+        succeeded = sum(executor.map(invoke, range(request_count)))
+    print(f"Warmed up {endpoint_name} on {instance_count} instances ({succeeded}/{request_count} requests succeeded)")
+
+
+# Poll the endpoint and warm up as soon as a scale out adds instances
+def watch_and_warm_up(endpoint_name=ENDPOINT_NAME, poll_seconds=30):
+    sagemaker_client = boto3.client('sagemaker')
+    known_instance_count = None
+    while True:
+        variant = sagemaker_client.describe_endpoint(EndpointName=endpoint_name)['ProductionVariants'][0]
+        instance_count = variant.get('CurrentInstanceCount', 0)
+        if known_instance_count is not None and instance_count > known_instance_count:
+            print(f"{endpoint_name} scaled out from {known_instance_count} to {instance_count} instances")
+            warm_up(endpoint_name)
+        known_instance_count = instance_count
+        time.sleep(poll_seconds)
+
+
+class SimulatedEndpoint:
+    """Minute by minute model of an endpoint under target tracking, used to replay recorded traffic locally.
+
+    Scale out follows CloudWatch's target tracking alarms (3 minutes above target), scale in needs 15 minutes below.
+    New instances serve traffic only after instance_startup_minutes. Off hours follow schedule_scale_down, weekdays only.
+    Only policies that can be deployed are modelled, so there is no scale to zero, which is a manual action.
+    """
+
+    def __init__(self, min_instances=1, max_instances=2, target_invocations_per_instance=TARGET_INVOCATIONS_PER_INSTANCE,
+                 capacity_per_instance=60, instance_startup_minutes=8, scale_out_cooldown_minutes=SCALE_OUT_COOLDOWN_SECONDS // 60,
+                 scale_in_cooldown_minutes=SCALE_IN_COOLDOWN_SECONDS // 60, off_hours=None, off_hours_max_instances=1):
+        if min_instances < 1:
+            raise ValueError("min_instances must be at least 1, real time endpoints cannot autoscale to zero")
+        self.min_instances = min_instances
+        self.max_instances = max_instances
+        self.target = target_invocations_per_instance
+        self.capacity_per_instance = capacity_per_instance
+        self.instance_startup_minutes = instance_startup_minutes
+        self.scale_out_cooldown_minutes = scale_out_cooldown_minutes
+        self.scale_in_cooldown_minutes = scale_in_cooldown_minutes
+        self.off_hours = off_hours  # (scale down hour, scale up hour) in UTC, as passed to schedule_scale_down
+        self.off_hours_max_instances = off_hours_max_instances
+
+    def _is_off_hours(self, minute_start):
+        # the scheduled actions fire on weekdays only, whichever fired last is in effect
+        start, end = self.off_hours
+        for hours_back in range(8 * 24):
+            moment = time.gmtime(minute_start - 3600 * hours_back)
+            if moment.tm_wday < 5 and moment.tm_hour in (start, end):
+                return moment.tm_hour == start
+        return False
+
+    def _max_instances_at(self, minute_start):
+        if self.off_hours is None or minute_start is None or not self._is_off_hours(minute_start):
+            return self.max_instances
+        return min(self.max_instances, self.off_hours_max_instances)
+
+    def replay(self, invocations_per_minute, start_timestamp=None):
+        in_service = self.min_instances
+        pending = []  # minutes at which pending instances come into service
+        minutes_above, minutes_below = 0, 0
+        last_scale_out, last_scale_in = -math.inf, -math.inf
+        report = {"minutes": len(invocations_per_minute), "invocations": 0, "served": 0, "rejected": 0,
+                  "instance_minutes": 0, "peak_instances": in_service, "scale_outs": 0, "scale_ins": 0}
+
+        for minute, invocations in enumerate(invocations_per_minute):
+            minute_start = start_timestamp + 60 * minute if start_timestamp is not None else None
+            in_service += sum(1 for ready in pending if ready == minute)
+            pending = [ready for ready in pending if ready > minute]
+            max_instances = self._max_instances_at(minute_start)
+
+            served = min(invocations, in_service * self.capacity_per_instance)
+            report["invocations"] += invocations
+            report["served"] += served
+            report["rejected"] += invocations - served
+            report["instance_minutes"] += in_service + len(pending)
+            report["peak_instances"] = max(report["peak_instances"], in_service + len(pending))
+
+            desired = min(max(math.ceil(invocations / self.target), self.min_instances), max_instances)
+            minutes_above = minutes_above + 1 if desired > in_service + len(pending) else 0
+            minutes_below = minutes_below + 1 if desired < in_service and not pending else 0
+
+            if minutes_above >= 3 and minute - last_scale_out >= self.scale_out_cooldown_minutes:
+                pending += [minute + self.instance_startup_minutes] * (desired - in_service - len(pending))
+                last_scale_out, minutes_above = minute, 0
+                report["scale_outs"] += 1
+            elif in_service > max_instances or (minutes_below >= 15 and minute - last_scale_in >= self.scale_in_cooldown_minutes):
+                in_service = min(desired, max_instances) if in_service > max_instances else desired
+                last_scale_in, minutes_below = minute, 0
+                report["scale_ins"] += 1
+        return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the capacity of the LLM endpoint.")
+    parser.add_argument('action', choices=['autoscale', 'schedule', 'scale-to-zero', 'scale-from-zero', 'warm-up', 'watch'])
+    parser.add_argument('--endpoint-name', type=str, default=ENDPOINT_NAME)
+    parser.add_argument('--min-instances', type=int, default=1)
+    parser.add_argument('--max-instances', type=int, default=2)
+    parser.add_argument('--target', type=int, help='Invocations per instance per minute to track.', default=TARGET_INVOCATIONS_PER_INSTANCE)
+    parser.add_argument('--off-hours', type=int, nargs=2, metavar=('START', 'END'), help='UTC hours of the weekday scale down and scale up.', default=OFF_HOURS)
+    parser.add_argument('--off-hours-max-instances', type=int, default=1)
+    args = parser.parse_args()
+
+    if args.action == 'autoscale':
+        configure_autoscaling(args.endpoint_name, args.min_instances, args.max_instances, args.target)
+    elif args.action == 'schedule':
+        schedule_scale_down(args.endpoint_name, args.min_instances, args.max_instances, args.off_hours_max_instances, tuple(args.off_hours))
+    elif args.action == 'scale-to-zero':
+        scale_to_zero(args.endpoint_name)
+    elif args.action == 'scale-from-zero':
+        scale_from_zero(args.endpoint_name, args.min_instances, args.max_instances)
+    elif args.action == 'warm-up':
+        warm_up(args.endpoint_name)
+    else:
+        watch_and_warm_up(args.endpoint_name)
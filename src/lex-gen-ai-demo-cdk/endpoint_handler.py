@@ -3,6 +3,7 @@ import boto3
 import time
 from sagemaker.huggingface import get_huggingface_llm_image_uri
 from sagemaker.huggingface import HuggingFaceModel
+from endpoint_capacity import configure_autoscaling, warm_up
 
 # get image from huggingface
 llm_image = get_huggingface_llm_image_uri(
@@ -64,7 +65,8 @@ health_check_timeout = 300
 trust_remote_code = True
 
 # Create sagemaker endpoint, default values are flan t5 xxl in a g5.8xl instance
-def create_endpoint_from_HF_image(hf_model_id, instance_type="ml.g5.8xlarge", endpoint_name=SAGEMAKER_ENDPOINT_NAME, number_of_gpu=1):
+# With max_instance_count above 1 the endpoint autoscales on invocations per instance, see endpoint_capacity.py
+def create_endpoint_from_HF_image(hf_model_id, instance_type="ml.g5.8xlarge", endpoint_name=SAGEMAKER_ENDPOINT_NAME, number_of_gpu=1, max_instance_count=1):
     sagemaker_client = boto3.client('sagemaker')
 
     try: # check if endpoint already existst
@@ -97,3 +99,7 @@ def create_endpoint_from_HF_image(hf_model_id, instance_type="ml.g5.8xlarge", en
         )
 
         print(f"\nEndpoint created ({endpoint_name})")
+
+        warm_up(endpoint_name)
+        if max_instance_count > 1:
+            configure_autoscaling(endpoint_name, min_instance_count=1, max_instance_count=max_instance_count)
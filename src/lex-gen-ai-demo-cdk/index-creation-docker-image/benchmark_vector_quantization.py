@@ -0,0 +1,134 @@
+# Compares the reduced/quantized search vectors against the full precision baseline the runtime otherwise holds in memory.
+# Run locally, with the index creation requirements installed, against a published index
+#   python3 benchmark_vector_quantization.py --vector-store path/to/vector_store.json
+# Only a real vector store says how much recall the projection costs. Synthetic embeddings are a smoke test
+#   python3 benchmark_vector_quantization.py --synthetic 50000
+import argparse
+import json
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from llama_index.vector_stores.simple import SimpleVectorStore, SimpleVectorStoreData
+from llama_index.vector_stores.types import VectorStoreQuery
+
+from vector_quantization import QuantizedVectors, normalize_rows
+
+TOP_K = 5
+
+
+def load_vector_store(path):
+    with open(path) as f:
+        embedding_dict = json.load(f)["embedding_dict"]
+    return list(embedding_dict.keys()), list(embedding_dict.values())
+
+
+def synthetic_embeddings(count, dimensions):
+    # variance spread over every dimension with a power law decay and a shared mean direction, so a projection loses
+    # some of it (about 15% beyond 256 of 768 dimensions) the way it does for sentence embeddings
+    rng = np.random.default_rng(0)
+    scales = np.arange(1, dimensions + 1, dtype=np.float32) ** -0.5
+    basis, _ = np.linalg.qr(rng.standard_normal((dimensions, dimensions)).astype(np.float32))
+    embeddings = (rng.standard_normal((count, dimensions)).astype(np.float32) * scales) @ basis.T + 0.5 * basis[:, 0]
+    return [str(i) for i in range(count)], embeddings.tolist()
+
+
+def baseline_memory(embeddings):
+    # SimpleVectorStore parses vector_store.json and keeps every embedding as a python list of floats
+    serialized = json.dumps(embeddings)
+    tracemalloc.start()
+    parsed = json.loads(serialized)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del parsed
+    return memory
+
+
+def percentile_ms(latencies, percentile):
+    return 1000 * float(np.percentile(latencies, percentile))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--vector-store', type=str, help='Path to a vector_store.json from a published index.', default=None)
+    parser.add_argument('--synthetic', type=int, help='Number of synthetic embeddings to generate instead.', default=10000)
+    parser.add_argument('--dimensions', type=int, help='Dimensions of synthetic embeddings.', default=768)
+    parser.add_argument('--reduced-dimensions', type=int, help='Dimensions kept after projection.', default=256)
+    parser.add_argument('--shortlist', type=int, help='Candidates re-ranked exactly per query.', default=50)
+    parser.add_argument('--queries', type=int, help='Number of queries to run.', default=200)
+    parser.add_argument('--list-queries', type=int, help='Queries timed on the slow llama-index list baseline.', default=20)
+    args = parser.parse_args()
+
+    if args.vector_store is not None:
+        node_ids, embeddings = load_vector_store(args.vector_store)
+    else:
+        node_ids, embeddings = synthetic_embeddings(args.synthetic + args.queries, args.dimensions)
+        print("Synthetic embeddings, recall only shows the search works. Use --vector-store for numbers to quote")
+
+    if args.queries < 1 or len(node_ids) < 2:
+        parser.error("need at least one query and two embeddings, one to hold out as a query and one to search")
+
+    # queries are held out embeddings that are not in the searched set, rather than copies of stored ones
+    rng = np.random.default_rng(1)
+    query_count = max(1, min(args.queries, len(node_ids) // 10))
+    held_out = set(rng.choice(len(node_ids), query_count, replace=False).tolist())
+    queries = np.asarray([embeddings[i] for i in sorted(held_out)], dtype=np.float32)
+    node_ids = [node_id for i, node_id in enumerate(node_ids) if i not in held_out]
+    embeddings = [embedding for i, embedding in enumerate(embeddings) if i not in held_out]
+    full_vectors = normalize_rows(np.asarray(embeddings, dtype=np.float32))
+
+    baseline_results, baseline_latencies = [], []
+    for query in queries:
+        start = time.perf_counter()
+        scores = full_vectors @ (query / np.linalg.norm(query))
+        baseline_results.append(set(np.argsort(-scores)[:TOP_K].tolist()))
+        baseline_latencies.append(time.perf_counter() - start)
+
+    # the search the runtime does without compact vectors, SimpleVectorStore scoring one python list at a time
+    vector_store = SimpleVectorStore(data=SimpleVectorStoreData(embedding_dict=dict(zip(node_ids, embeddings))))
+    position_of = {node_id: position for position, node_id in enumerate(node_ids)}
+    list_hits, list_latencies = 0, []
+    for query, expected in list(zip(queries, baseline_results))[:args.list_queries]:
+        start = time.perf_counter()
+        result = vector_store.query(VectorStoreQuery(query_embedding=query.tolist(), similarity_top_k=TOP_K))
+        list_latencies.append(time.perf_counter() - start)
+        list_hits += len(expected & {position_of[node_id] for node_id in result.ids})
+
+    print(f"{len(node_ids)} embeddings of {full_vectors.shape[1]} dimensions, {len(queries)} held out queries "
+          f"({len(list_latencies)} on the list baseline)")
+    print(f"{'configuration':<34}{'search memory MB':>18}{'p50 ms':>10}{'p95 ms':>10}{'recall@5':>10}")
+    if list_latencies:
+        print(f"{'float baseline (lists)':<34}{baseline_memory(embeddings) / 2**20:>18.1f}"
+              f"{percentile_ms(list_latencies, 50):>10.2f}{percentile_ms(list_latencies, 95):>10.2f}"
+              f"{list_hits / (TOP_K * len(list_latencies)):>10.3f}")
+    print(f"{'float baseline (numpy)':<34}{full_vectors.nbytes / 2**20:>18.1f}"
+          f"{percentile_ms(baseline_latencies, 50):>10.2f}{percentile_ms(baseline_latencies, 95):>10.2f}{1.0:>10.3f}")
+
+    # a shortlist of TOP_K re-ranks nothing, that row shows the recall the projection alone gives
+    configurations = [
+        ("int8", None, True, args.shortlist),
+        (f"pca {args.reduced_dimensions}", args.reduced_dimensions, False, args.shortlist),
+        (f"pca {args.reduced_dimensions} + int8", args.reduced_dimensions, True, args.shortlist),
+        (f"pca {args.reduced_dimensions} + int8, no re-rank", args.reduced_dimensions, True, TOP_K),
+    ]
+    for name, reduced_dimensions, quantize, shortlist in configurations:
+        with tempfile.TemporaryDirectory() as directory:
+            # round trip through disk so the full vectors are memory mapped the way the runtime loads them
+            QuantizedVectors.fit(node_ids, embeddings, reduced_dimensions, quantize).save(directory)
+            vectors = QuantizedVectors.load(directory)
+
+            hits, latencies = 0, []
+            for query, expected in zip(queries, baseline_results):
+                start = time.perf_counter()
+                results = vectors.search(query, TOP_K, shortlist)
+                latencies.append(time.perf_counter() - start)
+                hits += len(expected & {position_of[node_id] for node_id, _ in results})
+            print(f"{name:<34}{vectors.nbytes / 2**20:>18.1f}{percentile_ms(latencies, 50):>10.2f}"
+                  f"{percentile_ms(latencies, 95):>10.2f}{hits / (TOP_K * len(queries)):>10.3f}")
+            del vectors
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+# Exact and near-duplicate detection for text chunks.
+# The web crawler and index creation images are built from separate docker contexts, so an identical copy of this
+# file lives in both web-crawler-docker-image and index-creation-docker-image. Keep them in sync.
+import hashlib
+import re
+from collections import Counter
+from typing import Dict, FrozenSet, List, Optional, Tuple
+
+SIMHASH_BITS = 64
+NEAR_DUPLICATE_DISTANCE = 6  # max number of differing simhash bits for two chunks to be compared as near duplicates
+BANDS = NEAR_DUPLICATE_DISTANCE + 1  # with this many bands, near duplicates always share at least one band exactly
+BAND_BITS = SIMHASH_BITS // BANDS
+SHINGLE_SIZE = 2
+MIN_WORDS_FOR_SIMHASH = 20  # shorter chunks are only deduplicated on exact matches
+# a block of page text is boilerplate once it repeats on this many pages, shorter blocks are never dropped since
+# answers such as "Yes." legitimately repeat
+BOILERPLATE_MIN_PAGES = 3
+BOILERPLATE_MIN_WORDS = 8
+
+EXACT_DUPLICATE = "exact"
+NEAR_DUPLICATE = "near"
+
+
+def normalize(text: str) -> str:
+    return re.sub(r"\s+", " ", text.lower()).strip()
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(normalize(text).encode("utf-8")).hexdigest()
+
+
+def words(text: str) -> List[str]:
+    return re.findall(r"\w+", text.lower())
+
+
+def shingles(text: str) -> List[str]:
+    text_words = words(text)
+    if len(text_words) < MIN_WORDS_FOR_SIMHASH:
+        return []
+    return [" ".join(text_words[i:i + SHINGLE_SIZE]) for i in range(len(text_words) - SHINGLE_SIZE + 1)]
+
+
+def simhash(text: str) -> Optional[int]:
+    text_shingles = shingles(text)
+    if len(text_shingles) == 0:
+        return None
+
+    weights = [0] * SIMHASH_BITS
+    for shingle in text_shingles:
+        shingle_hash = int.from_bytes(hashlib.md5(shingle.encode("utf-8")).digest()[:8], "big")
+        for bit in range(SIMHASH_BITS):
+            weights[bit] += 1 if shingle_hash >> bit & 1 else -1
+    return sum(1 << bit for bit in range(SIMHASH_BITS) if weights[bit] > 0)
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class DedupIndex:
+    """Signatures of every chunk kept so far.
+
+    Only the exact hashes are persisted with to_dict and from_dict, so a later build can tell whether its chunks changed.
+    Near duplicates are only detected within one run, they need the words of the chunks kept in memory.
+    """
+
+    def __init__(self):
+        self.hashes = set()
+        self.simhashes: List[int] = []
+        self._words: List[FrozenSet[str]] = []
+        self._bands: List[Dict[int, List[int]]] = [{} for _ in range(BANDS)]
+        self.exact_duplicates = 0
+        self.near_duplicates = 0
+
+    @property
+    def dropped(self) -> int:
+        return self.exact_duplicates + self.near_duplicates
+
+    def add(self, text: str) -> Optional[str]:
+        """Record text and return None, or return EXACT_DUPLICATE or NEAR_DUPLICATE without recording it."""
+        text_hash = content_hash(text)
+        if text_hash in self.hashes:
+            self.exact_duplicates += 1
+            return EXACT_DUPLICATE
+
+        text_words = frozenset(words(text))
+        text_simhash = simhash(text)
+        if text_simhash is not None and self._has_near_duplicate(text_simhash, text_words):
+            self.near_duplicates += 1
+            return NEAR_DUPLICATE
+
+        self.hashes.add(text_hash)
+        if text_simhash is not None:
+            self._add_simhash(text_simhash, text_words)
+        return None
+
+    def _band_keys(self, value: int):
+        mask = (1 << BAND_BITS) - 1
+        return [(value >> (band * BAND_BITS)) & mask for band in range(BANDS)]
+
+    def _has_near_duplicate(self, value: int, text_words: FrozenSet[str]) -> bool:
+        # simhash only finds candidates, a chunk differing in a single fact ("15 days" vs "60 days") can be as close
+        # as a trimmed footer. A candidate is a duplicate only if it already contains every word of the new chunk,
+        # so dropping the new chunk never drops a fact the index does not have
+        for band, key in enumerate(self._band_keys(value)):
+            for candidate in self._bands[band].get(key, []):
+                if hamming_distance(value, self.simhashes[candidate]) <= NEAR_DUPLICATE_DISTANCE \
+                        and text_words <= self._words[candidate]:
+                    return True
+        return False
+
+    def _add_simhash(self, value: int, text_words: FrozenSet[str]):
+        self.simhashes.append(value)
+        self._words.append(text_words)
+        for band, key in enumerate(self._band_keys(value)):
+            self._bands[band].setdefault(key, []).append(len(self.simhashes) - 1)
+
+    def to_dict(self) -> dict:
+        return {"hashes": sorted(self.hashes)}
+
+    @classmethod
+    def from_dict(cls, signatures: dict) -> "DedupIndex":
+        # signatures written before simhashes were dropped from the format still load, their simhashes are ignored
+        dedup_index = cls()
+        dedup_index.hashes = set(signatures["hashes"])
+        return dedup_index
+
+
+def drop_boilerplate_blocks(pages: List[str]) -> Tuple[List[str], int]:
+    """Drop blocks of page text that repeat across pages (headers, footers, navigation) after their first page.
+
+    Blocks are only compared across pages, never within one, and only once they appear on BOILERPLATE_MIN_PAGES pages.
+    Returns the pages and the number of blocks dropped.
+    """
+    page_blocks = [[block for block in page.split("\n\n") if block.strip()] for page in pages]
+    pages_per_block = Counter(block_hash for blocks in page_blocks for block_hash in {content_hash(block) for block in blocks})
+
+    seen_on_earlier_page = set()
+    kept_pages, dropped = [], 0
+    for blocks in page_blocks:
+        kept_blocks = []
+        for block in blocks:
+            block_hash = content_hash(block)
+            if block_hash in seen_on_earlier_page and pages_per_block[block_hash] >= BOILERPLATE_MIN_PAGES \
+                    and len(words(block)) >= BOILERPLATE_MIN_WORDS:
+                dropped += 1
+            else:
+                kept_blocks.append(block)
+        seen_on_earlier_page.update(content_hash(block) for block in blocks)
+        if kept_blocks:
+            kept_pages.append("\n\n".join(kept_blocks))
+    return kept_pages, dropped
@@ -6,17 +6,26 @@ import logging
 from langchain.llms.base import LLM
 from typing import Optional, List, Mapping, Any
 import os
+import shutil
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote_plus
 from llama_index import (
     LangchainEmbedding,
     GPTVectorStoreIndex,
     LLMPredictor,
     ServiceContext,
+    StorageContext,
     Document,
     PromptHelper,
     download_loader
 )
 
 from langchain.embeddings import HuggingFaceEmbeddings
+from content_dedup import DedupIndex
+from vector_quantization import QuantizedVectors, QUANTIZED_VECTORS_FILE, FULL_VECTORS_FILE
+from node_text_store import write_node_store, NODE_STORE_FILE
 
 import logging
 from botocore.exceptions import ClientError
@@ -30,38 +39,140 @@ S3_BUCKET = "lexgenaistack-source-materials-bucket-"+ACCOUNT_ID
 ENDPOINT_NAME = "huggingface-pytorch-sagemaker-endpoint"
 DELIMITER = "\n\n\n"
 LOCAL_INDEX_LOC = "/tmp/index_files"
+LOCAL_SOURCE_LOC = "/tmp/source_files"
+LOCAL_PARTIAL_INDEX_LOC = "/tmp/partial_index_files"
+
+# bulk uploads land in their own bucket with no event notification and are indexed together by a single
+# {"bucket": ..., "prefix": ...} invocation instead of one index build per object created
+PARTIAL_INDEX_PREFIX = "partial-indexes/"
+INDEX_VERSIONS_PREFIX = "versions/"
+MANIFEST_KEY = "manifest.json"
+SIGNATURES_FILE = "signatures.json"
+INDEX_VERSIONS_TO_KEEP = 5  # newest published versions kept for rollback, older ones are deleted on each publish
+# source files indexed by one worker invocation, smaller builds run in this invocation. Every stage of a fan-out build
+# (start, each shard, merge) is its own invocation with its own 15 minute limit, a shard must embed well within it
+DOCUMENTS_PER_SHARD = 20
+MAX_INVOKE_WORKERS = 16
+MAX_DOWNLOAD_WORKERS = 16
+
+# compact search vectors published for the runtime lambda, see vector_quantization.py
+# set EMBEDDING_DIMENSIONS to None to keep every dimension and QUANTIZE_EMBEDDINGS to False to keep float32 values
+EMBEDDING_DIMENSIONS = 256
+QUANTIZE_EMBEDDINGS = True
+# files the runtime loads from a version, a published version missing any of them is rebuilt even if its chunks match
+RUNTIME_INDEX_FILES = [SIGNATURES_FILE, QUANTIZED_VECTORS_FILE, FULL_VECTORS_FILE, NODE_STORE_FILE]
 
 def handler(event, context):
-    event_record = event['Records'][0]
-    if event_record['eventName'] == "ObjectCreated:Put":
-        if ".txt" in event_record['s3']['object']['key'].lower() or ".pdf" in event_record['s3']['object']['key'].lower():
-            source_material_key = event_record['s3']['object']['key']
-            logger.info(f"Source file {source_material_key} found")
-        else:
-            logger.error("INVALID FILE, MUST END IN .TXT or .PDF")
-            return
+    # worker invocation of a fan-out build, embed one shard and write a partial index
+    if "shard_keys" in event:
+        return build_partial_index(event, context.function_name)
+    # last stage of a fan-out build, started once every worker has written its partial index
+    if "merge_build_prefix" in event:
+        return merge_partial_indexes(event["merge_build_prefix"], event["shard_count"])
+
+    bucket = event.get("bucket", S3_BUCKET)
+    if "prefix" in event:
+        source_material_keys = list_source_keys(event["prefix"], bucket)
     else:
-        logger.error("NON OBJECTCREATION INVOCATION")
+        source_material_keys = get_source_keys_from_records(event.get("Records", []))
+
+    if len(source_material_keys) == 0:
+        logger.error("NO .TXT OR .PDF SOURCE FILES TO INDEX")
         return
-    
-    s3_client = boto3.client('s3')
-    try:
-        s3_client.download_file(S3_BUCKET, source_material_key, "/tmp/"+source_material_key)
-        logger.info(f"Downloaded {source_material_key}")
-    except ClientError as e:
-        logger.error(e)
+    logger.info(f"Indexing {len(source_material_keys)} source files")
+
+    if len(source_material_keys) > DOCUMENTS_PER_SHARD:
+        start_fan_out(source_material_keys, bucket, context.function_name)
+        return
+
+    documents = load_documents(source_material_keys, bucket)
+    if len(documents) == 0:
         return "ERROR READING FILE"
-    
-    if ".pdf" in source_material_key.lower():
+    service_context = get_service_context()
+    publish_nodes(service_context.node_parser.get_nodes_from_documents(documents), service_context)
+    return
+
+def publish_nodes(nodes, service_context):
+    # workers already deduplicated their own shard, this also catches chunks repeated across shards
+    nodes, dedup_index = deduplicate_nodes(nodes)
+    if is_published(dedup_index):
+        logger.info("Source content and build settings are unchanged from the published index, skipping publish")
+        return
+
+    index = GPTVectorStoreIndex(nodes, service_context=service_context)
+    publish_index(index, dedup_index)
+    logger.info("Index successfully created")
+
+def is_source_file(key):
+    return key.lower().endswith(".txt") or key.lower().endswith(".pdf")
+
+def get_source_keys_from_records(records):
+    source_material_keys = []
+    for event_record in records:
+        if not event_record['eventName'].startswith("ObjectCreated:"):
+            logger.error("NON OBJECTCREATION INVOCATION")
+            continue
+        # keys in s3 event notifications are url encoded
+        key = unquote_plus(event_record['s3']['object']['key'])
+        if is_source_file(key):
+            logger.info(f"Source file {key} found")
+            source_material_keys.append(key)
+        else:
+            logger.error(f"INVALID FILE {key}, MUST END IN .TXT or .PDF")
+    return source_material_keys
+
+def list_source_keys(prefix, bucket=S3_BUCKET):
+    s3_client = boto3.client('s3')
+    paginator = s3_client.get_paginator('list_objects_v2')
+    keys = []
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        keys.extend(obj['Key'] for obj in page.get('Contents', []))
+    return [key for key in keys if is_source_file(key)]
+
+def load_documents(source_material_keys, bucket=S3_BUCKET):
+    if not os.path.exists(LOCAL_SOURCE_LOC):
+        os.mkdir(LOCAL_SOURCE_LOC)
+
+    s3_client = boto3.client('s3')
+    def download(source_material_key):
+        # keys are flattened to unique names, read_documents only needs the extension to pick a reader
+        local_path = LOCAL_SOURCE_LOC + "/" + uuid.uuid4().hex + os.path.splitext(source_material_key)[1].lower()
+        try:
+            s3_client.download_file(bucket, source_material_key, local_path)
+            logger.info(f"Downloaded {source_material_key}")
+            return local_path
+        except ClientError as e:
+            logger.error(e)
+            return None
+
+    with ThreadPoolExecutor(max_workers=MAX_DOWNLOAD_WORKERS) as executor:
+        local_paths = list(executor.map(download, source_material_keys))
+
+    documents = []
+    for source_material_key, local_path in zip(source_material_keys, local_paths):
+        if local_path is None:
+            continue
+        try:
+            documents.extend(read_documents(local_path))
+        except Exception as e:
+            # a corrupt PDF or a text file that is not UTF-8 is skipped, failing would fail every retry of a shard too
+            logger.error(f"Failed to read {source_material_key}, skipping it: {e}")
+        finally:
+            os.remove(local_path)
+    return documents
+
+def read_documents(local_path):
+    if local_path.lower().endswith(".pdf"):
         PDFReader = download_loader("PDFReader", custom_path="/tmp/llama_cache")
         loader = PDFReader()
-        documents = loader.load_data(file=Path("/tmp/"+source_material_key))
-    else:
-        with open("/tmp/"+source_material_key) as f:
-            text_list = f.read().split(DELIMITER)
-        logger.info(f"Reading text with delimiter {repr(DELIMITER)}")
-        documents = [Document(t) for t in text_list]
-    
+        return loader.load_data(file=Path(local_path))
+
+    with open(local_path) as f:
+        text_list = f.read().split(DELIMITER)
+    logger.info(f"Reading text with delimiter {repr(DELIMITER)}")
+    return [Document(t) for t in text_list]
+
+def get_service_context():
     # define prompt helper
     max_input_size = 400  # set maximum input size
     num_output = 50  # set number of output tokens
@@ -71,18 +182,203 @@ def handler(event, context):
     # define our LLM
     llm_predictor = LLMPredictor(llm=CustomLLM())
     embed_model = LangchainEmbedding(HuggingFaceEmbeddings(cache_folder="/tmp/HF_CACHE"))
-    service_context = ServiceContext.from_defaults(
+    return ServiceContext.from_defaults(
         llm_predictor=llm_predictor, prompt_helper=prompt_helper, embed_model=embed_model,
     )
 
-    index = GPTVectorStoreIndex.from_documents(documents, service_context=service_context)
+def deduplicate_nodes(nodes):
+    dedup_index = DedupIndex()
+    kept_nodes = [node for node in nodes if dedup_index.add(node.get_text()) is None]
+    logger.info(f"Dropped {dedup_index.dropped} duplicate chunks ({dedup_index.exact_duplicates} exact, "
+                f"{dedup_index.near_duplicates} near duplicates), keeping {len(kept_nodes)}")
+    return kept_nodes, dedup_index
+
+def start_fan_out(source_material_keys, bucket, function_name):
+    build_prefix = PARTIAL_INDEX_PREFIX + uuid.uuid4().hex + "/"
+    shards = [source_material_keys[i:i+DOCUMENTS_PER_SHARD] for i in range(0, len(source_material_keys), DOCUMENTS_PER_SHARD)]
+    logger.info(f"Fanning out {len(source_material_keys)} source files to {len(shards)} workers under {build_prefix}")
+
+    # asynchronous invokes, nothing waits on a worker. Invokes over the concurrency limit are queued and retried by
+    # lambda, so large builds run in as many waves as needed without a coordinator timing out
+    lambda_client = boto3.client('lambda')
+    def invoke_worker(shard_number):
+        payload = {
+            "shard_keys": shards[shard_number],
+            "bucket": bucket,
+            "build_prefix": build_prefix,
+            "shard_number": shard_number,
+            "shard_count": len(shards)
+        }
+        lambda_client.invoke(FunctionName=function_name, InvocationType='Event', Payload=json.dumps(payload))
+
+    with ThreadPoolExecutor(max_workers=MAX_INVOKE_WORKERS) as executor:
+        list(executor.map(invoke_worker, range(len(shards))))
+
+def shard_prefix(build_prefix, shard_number):
+    return build_prefix + "shards/" + str(shard_number) + "/"
+
+def build_partial_index(event, function_name):
+    build_prefix, shard_number, shard_count = event["build_prefix"], event["shard_number"], event["shard_count"]
+    documents = load_documents(event["shard_keys"], event.get("bucket", S3_BUCKET))
+    service_context = get_service_context()
+    nodes, dedup_index = deduplicate_nodes(service_context.node_parser.get_nodes_from_documents(documents))
+    index = GPTVectorStoreIndex(nodes, service_context=service_context)
+
+    local_dir = LOCAL_PARTIAL_INDEX_LOC + "/" + uuid.uuid4().hex
+    index.storage_context.persist(persist_dir=local_dir)
+    s3_client = boto3.client('s3')
+    for file in os.listdir(local_dir):
+        s3_client.upload_file(local_dir+"/"+file, INDEX_BUCKET, shard_prefix(build_prefix, shard_number)+file)
+    shutil.rmtree(local_dir)
+    logger.info(f"Partial index of {len(documents)} documents written for shard {shard_number} of {shard_count}")
+
+    # one marker per finished shard is the completion counter. S3 listings are strongly consistent, so whichever
+    # worker finishes last sees every marker and starts the merge as a fresh invocation
+    s3_client.put_object(Bucket=INDEX_BUCKET, Key=build_prefix+"done/"+str(shard_number), Body=b"")
+    if count_objects(INDEX_BUCKET, build_prefix+"done/") == shard_count and claim_merge(s3_client, build_prefix):
+        try:
+            boto3.client('lambda').invoke(
+                FunctionName=function_name,
+                InvocationType='Event',
+                Payload=json.dumps({"merge_build_prefix": build_prefix, "shard_count": shard_count})
+            )
+        except ClientError:
+            # release the claim so lambda's retry of this worker can start the merge again
+            s3_client.delete_object(Bucket=INDEX_BUCKET, Key=build_prefix+"merge.lock")
+            raise
+        logger.info(f"All {shard_count} shards finished, merge of {build_prefix} started")
+    return {
+        "status": 200,
+        "shard_number": shard_number,
+        "duplicate_chunks_dropped": dedup_index.dropped
+    }
+
+def claim_merge(s3_client, build_prefix):
+    # workers finishing together can both see the last marker, the conditional put (boto3 >= 1.35.16) lets exactly one
+    # start the merge
+    try:
+        s3_client.put_object(Bucket=INDEX_BUCKET, Key=build_prefix+"merge.lock", Body=b"", IfNoneMatch="*")
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] in ("PreconditionFailed", "ConditionalRequestConflict"):
+            return False
+        raise
+
+def merge_partial_indexes(build_prefix, shard_count):
+    nodes = load_partial_index_nodes([shard_prefix(build_prefix, shard_number) for shard_number in range(shard_count)])
+    publish_nodes(nodes, get_service_context())
+    delete_prefix(INDEX_BUCKET, build_prefix)
+
+def load_partial_index_nodes(partial_index_prefixes):
+    s3_client = boto3.client('s3')
+    def load(partial_index_prefix):
+        local_dir = LOCAL_PARTIAL_INDEX_LOC + "/" + uuid.uuid4().hex
+        os.makedirs(local_dir)
+        for file in ["docstore.json", "index_store.json", "vector_store.json"]:
+            s3_client.download_file(INDEX_BUCKET, partial_index_prefix+file, local_dir+"/"+file)
+
+        # nodes keep the embedding computed by the worker so the merged index does not re-embed them
+        storage_context = StorageContext.from_defaults(persist_dir=local_dir)
+        nodes = list(storage_context.docstore.docs.values())
+        for node in nodes:
+            node.embedding = storage_context.vector_store.get(node.get_doc_id())
+        shutil.rmtree(local_dir)
+        return nodes
+
+    with ThreadPoolExecutor(max_workers=MAX_DOWNLOAD_WORKERS) as executor:
+        nodes = [node for partial_nodes in executor.map(load, partial_index_prefixes) for node in partial_nodes]
+    logger.info(f"Merging {len(nodes)} nodes from {len(partial_index_prefixes)} partial indexes")
+    return nodes
+
+def count_objects(bucket, prefix):
+    s3_client = boto3.client('s3')
+    paginator = s3_client.get_paginator('list_objects_v2')
+    return sum(page.get('KeyCount', 0) for page in paginator.paginate(Bucket=bucket, Prefix=prefix))
+
+def delete_prefix(bucket, prefix):
+    s3_client = boto3.client('s3')
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        objects = [{'Key': obj['Key']} for obj in page.get('Contents', [])]
+        if objects:
+            s3_client.delete_objects(Bucket=bucket, Delete={'Objects': objects})
+
+# each build is written under its own immutable prefix, then manifest.json is pointed at it in a single PUT
+# so the runtime never sees a mix of files from two builds. Rolling back is rewriting the manifest
+def publish_index(index, dedup_index):
+    version = time.strftime("%Y%m%d-%H%M%S") + "-" + uuid.uuid4().hex[:8]
+    version_prefix = INDEX_VERSIONS_PREFIX + version + "/"
+
+    shutil.rmtree(LOCAL_INDEX_LOC, ignore_errors=True)
     index.storage_context.persist(persist_dir=LOCAL_INDEX_LOC)
+    # signatures of the published chunks, the next build compares against them to skip republishing unchanged content
+    with open(LOCAL_INDEX_LOC + "/" + SIGNATURES_FILE, "w") as f:
+        json.dump(dict(dedup_index.to_dict(), build_settings=build_settings()), f)
+    # the runtime loads only the search vectors and reads node text from the node store as needed
+    docs = index.docstore.docs
+    if len(docs) > 0:
+        write_search_vectors(docs, index.vector_store, LOCAL_INDEX_LOC)
+        write_node_store(LOCAL_INDEX_LOC + "/" + NODE_STORE_FILE, docs)
 
-    for file in os.listdir(LOCAL_INDEX_LOC):
-        s3_client.upload_file(LOCAL_INDEX_LOC+"/"+file, INDEX_BUCKET, file) # ASSUMES IT CAN OVERWRITE, I.E. S3 OBJECT LOCK MUST BE OFF
- 
-    logger.info("Index successfully created")
-    return
+    s3_client = boto3.client('s3')
+    files = os.listdir(LOCAL_INDEX_LOC)
+    for file in files:
+        s3_client.upload_file(LOCAL_INDEX_LOC+"/"+file, INDEX_BUCKET, version_prefix+file)
+
+    previous_manifest = read_manifest(s3_client)
+    manifest = {
+        "version": version,
+        "prefix": version_prefix,
+        "files": files,
+        "published_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "previous_version": previous_manifest["version"] if previous_manifest else None,
+        "duplicate_chunks_dropped": dedup_index.dropped
+    }
+    s3_client.put_object(Bucket=INDEX_BUCKET, Key=MANIFEST_KEY, Body=json.dumps(manifest), ContentType="application/json")
+    logger.info(f"Published index version {version}")
+    remove_old_index_versions(s3_client, [version, manifest["previous_version"]])
+    return version
+
+def remove_old_index_versions(s3_client, versions_in_use):
+    # version names start with the publish time, so sorting them orders them oldest first
+    paginator = s3_client.get_paginator('list_objects_v2')
+    versions = []
+    for page in paginator.paginate(Bucket=INDEX_BUCKET, Prefix=INDEX_VERSIONS_PREFIX, Delimiter="/"):
+        versions.extend(common_prefix['Prefix'][len(INDEX_VERSIONS_PREFIX):-1] for common_prefix in page.get('CommonPrefixes', []))
+    for version in sorted(versions)[:-INDEX_VERSIONS_TO_KEEP]:
+        if version not in versions_in_use:
+            delete_prefix(INDEX_BUCKET, INDEX_VERSIONS_PREFIX + version + "/")
+            logger.info(f"Deleted old index version {version}")
+
+def write_search_vectors(docs, vector_store, directory):
+    node_ids = list(docs.keys())
+    embeddings = [vector_store.get(node_id) for node_id in node_ids]
+    QuantizedVectors.fit(node_ids, embeddings, EMBEDDING_DIMENSIONS, QUANTIZE_EMBEDDINGS).save(directory)
+
+def read_manifest(s3_client):
+    try:
+        response = s3_client.get_object(Bucket=INDEX_BUCKET, Key=MANIFEST_KEY)
+        return json.loads(response['Body'].read().decode('utf-8'))
+    except s3_client.exceptions.NoSuchKey:
+        return None
+
+def build_settings():
+    # anything besides the chunks that changes what gets published, e.g. after editing EMBEDDING_DIMENSIONS
+    return {
+        "embedding_dimensions": EMBEDDING_DIMENSIONS,
+        "quantize_embeddings": QUANTIZE_EMBEDDINGS,
+        "files": sorted(RUNTIME_INDEX_FILES)
+    }
+
+def is_published(dedup_index):
+    s3_client = boto3.client('s3')
+    manifest = read_manifest(s3_client)
+    if manifest is None or not all(file in manifest["files"] for file in RUNTIME_INDEX_FILES):
+        return False
+    response = s3_client.get_object(Bucket=INDEX_BUCKET, Key=manifest["prefix"] + SIGNATURES_FILE)
+    signatures = json.loads(response['Body'].read().decode('utf-8'))
+    return signatures.get("build_settings") == build_settings() \
+        and DedupIndex.from_dict(signatures).hashes == dedup_index.hashes
 
 def call_sagemaker(prompt, endpoint_name=ENDPOINT_NAME):
     payload = {
@@ -0,0 +1,55 @@
+# Node text kept in a single SQLite file, so the runtime only reads the few nodes each answer needs instead of
+# parsing the whole docstore.json into memory.
+# The index creation and runtime images are built from separate docker contexts, so an identical copy of this file
+# lives in both index-creation-docker-image and lex-gen-ai-demo-docker-image. Keep them in sync.
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Dict
+
+from llama_index.data_structs.node import Node
+from llama_index.schema import BaseDocument
+from llama_index.storage.docstore.utils import doc_to_json, json_to_doc
+
+NODE_STORE_FILE = "node_store.sqlite"
+NODE_CACHE_SIZE = 256  # hot nodes kept parsed in memory
+
+
+def write_node_store(path: str, docs: Dict[str, BaseDocument]):
+    connection = sqlite3.connect(path)
+    try:
+        connection.execute("CREATE TABLE IF NOT EXISTS nodes (node_id TEXT PRIMARY KEY, payload TEXT NOT NULL)")
+        connection.executemany(
+            "INSERT OR REPLACE INTO nodes (node_id, payload) VALUES (?, ?)",
+            ((node_id, json.dumps(doc_to_json(doc))) for node_id, doc in docs.items())
+        )
+        connection.commit()
+    finally:
+        connection.close()
+
+
+class NodeTextStore:
+    """Read only stand-in for the docstore, fetches nodes by id on demand and keeps the most recent ones cached."""
+
+    def __init__(self, path: str, cache_size: int = NODE_CACHE_SIZE):
+        # built on the background reload thread and read by requests, access is serialized with the lock
+        self._connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+        self._cache: "OrderedDict[str, Node]" = OrderedDict()
+        self._cache_size = cache_size
+        self._lock = threading.Lock()
+
+    def get_node(self, node_id: str) -> Node:
+        with self._lock:
+            if node_id in self._cache:
+                self._cache.move_to_end(node_id)
+                return self._cache[node_id]
+
+            row = self._connection.execute("SELECT payload FROM nodes WHERE node_id = ?", (node_id,)).fetchone()
+            if row is None:
+                raise ValueError(f"node_id {node_id} not found.")
+            node = json_to_doc(json.loads(row[0]))
+            self._cache[node_id] = node
+            if len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+            return node
@@ -1,8 +1,11 @@
 import boto3
-from botocore.exceptions import ClientError
+from botocore.exceptions import BotoCoreError, ClientError
 import logging
 import json
 import os
+import shutil
+import threading
+import time
 from typing import Optional, List, Mapping, Any
 from langchain.llms.base import LLM
 from llama_index import (
@@ -19,6 +22,19 @@ from llama_index.query_engine import RetrieverQueryEngine
 from llama_index.retrievers import VectorIndexRetriever
 from llama_index.vector_stores.types import VectorStoreQueryMode
 from llama_index import StorageContext, load_index_from_storage
+from llama_index.data_structs.node import NodeWithScore
+from llama_index.indices.base_retriever import BaseRetriever
+from llama_index.indices.query.schema import QueryBundle
+from llama_index.storage.docstore import SimpleDocumentStore
+from vector_quantization import QuantizedVectors, QUANTIZED_VECTORS_FILE, FULL_VECTORS_FILE
+from node_text_store import NodeTextStore, NODE_STORE_FILE
+from session_context import (
+    load_session_context,
+    save_session_context,
+    is_follow_up,
+    rewrite_query,
+    blend_embeddings,
+)
 
 s3_client = boto3.client('s3')
 
@@ -31,6 +47,15 @@ INDEX_WRITE_LOCATION = "/tmp/index"
 ACCOUNT_ID = boto3.client('sts').get_caller_identity().get('Account')
 INDEX_BUCKET = "lexgenaistack-created-index-bucket-"+ACCOUNT_ID
 RETRIEVAL_THRESHOLD = 0.4
+MANIFEST_KEY = "manifest.json"
+MANIFEST_POLL_SECONDS = 60  # how often a warm lambda checks for a newly published index version
+INDEX_FILES = ["docstore.json", "index_store.json", "vector_store.json"]
+# newer index versions also publish compact search vectors and a node store, the most compact set available is loaded
+QUANTIZED_INDEX_FILES = ["docstore.json", QUANTIZED_VECTORS_FILE, FULL_VECTORS_FILE]
+LAZY_INDEX_FILES = [NODE_STORE_FILE, QUANTIZED_VECTORS_FILE, FULL_VECTORS_FILE]
+SIMILARITY_TOP_K = 5
+SHORTLIST_SIZE = 50  # candidates from the compact vectors that are re-ranked with full precision
+FOLLOW_UP_CONTEXT_WEIGHT = 0.3  # share of the previous question's embedding mixed into a follow up's search vector
 
 # define prompt helper
 max_input_size = 400  # set maximum input size
@@ -38,62 +63,198 @@ num_output = 50  # set number of output tokens
 max_chunk_overlap = 0  # set maximum chunk overlap
 prompt_helper = PromptHelper(max_input_size, num_output, max_chunk_overlap)
 
+# kept across warm invocations, query_engine is swapped for a new one once a newly published index has loaded
+service_context = None
+query_engine = None
+loaded_version = None
+last_manifest_check = 0
+reload_lock = threading.Lock()
+
 
 def handler(event, context):
 
     # lamda can only write to /tmp/
     initialize_cache()
 
-    # define our LLM
-    llm_predictor = LLMPredictor(llm=CustomLLM())
-    embed_model = LangchainEmbedding(HuggingFaceEmbeddings(cache_folder="/tmp/HF_CACHE"))
-    service_context = ServiceContext.from_defaults(
-        llm_predictor=llm_predictor, prompt_helper=prompt_helper, embed_model=embed_model,
-    )
+    engine = get_query_engine()
+    if engine is None:
+        return "ERROR LOADING/READING INDEX"
 
-    ### Download index here
-    if not os.path.exists(INDEX_WRITE_LOCATION):
-        os.mkdir(INDEX_WRITE_LOCATION)
+    query_input = event["inputTranscript"]
+    session_attributes = event["sessionState"].get("sessionAttributes") or {}
+
+    try:
+        session_context = load_session_context(session_attributes)
+        history = session_context["history"] if session_context else []
+        query_str = query_input
+        query_embedding = get_service_context().embed_model.get_query_embedding(query_input)
+        cached_node_ids = []
+        if session_context is not None and is_follow_up(query_input):
+            # follow ups borrow the previous turn's topic, in the prompt and in the search vector
+            query_str = rewrite_query(query_input, history)
+            if session_context.get("embedding"):
+                query_embedding = blend_embeddings(query_embedding, session_context["embedding"], FOLLOW_UP_CONTEXT_WEIGHT)
+            cached_node_ids = session_context.get("node_ids", [])
+
+        query_bundle = QueryBundle(query_str, embedding=query_embedding)
+        nodes = add_cached_nodes(engine.retrieve(query_bundle), engine.retriever, cached_node_ids, query_embedding)
+        answer = engine.synthesize(query_bundle, nodes)
+        if answer.source_nodes[0].score < RETRIEVAL_THRESHOLD:
+            answer = OUT_OF_DOMAIN_RESPONSE
+        else:
+            node_ids = [node_with_score.node.get_doc_id() for node_with_score in nodes]
+            session_attributes = save_session_context(session_attributes, node_ids, query_embedding, history + [query_input])
+    except:
+        answer = OUT_OF_DOMAIN_RESPONSE
+
+    response = generate_lex_response(event, session_attributes, "Fulfilled", answer)
+    jsonified_resp = json.loads(json.dumps(response, default=str))
+    return jsonified_resp
+
+def add_cached_nodes(nodes, retriever, cached_node_ids, query_embedding):
+    # the previous turn's nodes are rescored against this query and compete with the fresh results for the top spots
+    if len(cached_node_ids) == 0 or not isinstance(retriever, QuantizedVectorRetriever):
+        return nodes
+    retrieved_ids = {node_with_score.node.get_doc_id() for node_with_score in nodes}
+    cached_nodes = retriever.score_nodes([node_id for node_id in cached_node_ids if node_id not in retrieved_ids], query_embedding)
+    return sorted(nodes + cached_nodes, key=lambda node_with_score: node_with_score.score, reverse=True)[:SIMILARITY_TOP_K]
+
+def get_query_engine():
+    if query_engine is None:
+        # cold start, there is nothing to answer with yet so this request waits for the first load
+        refresh_index(blocking=True)
+    elif time.time() - last_manifest_check > MANIFEST_POLL_SECONDS and not reload_lock.locked():
+        # requests keep using the current engine while a new version downloads and loads in the background
+        threading.Thread(target=refresh_index, daemon=True).start()
+    return query_engine
+
+# lambda freezes the environment as soon as a response is returned, so a background reload only makes progress while
+# later requests are running and shares the CPU with them. The load time is logged to see how many requests that spans
+def refresh_index(blocking=False):
+    global query_engine, loaded_version, last_manifest_check
+    if not reload_lock.acquire(blocking=blocking):
+        return
+    index_dir = None
+    try:
+        last_manifest_check = time.time()
+        manifest = read_manifest()
+        version = manifest["version"] if manifest else None
+        if query_engine is not None and version == loaded_version:
+            return
+
+        start = time.time()
+        index_dir = local_index_dir(manifest)
+        download_index(manifest, index_dir)
+        engine = load_query_engine(index_dir)
+        query_engine = engine
+        loaded_version = version
+        logger.info(f"Index version {version} successfully loaded in {time.time() - start:.1f}s")
+        remove_stale_index_versions(index_dir)
+    except (ClientError, BotoCoreError, OSError) as e:
+        # connections can time out across a freeze and /tmp can run out of space, the current engine keeps serving
+        logger.error(f"Failed to load index version: {e}")
+        # a failed download is never the loaded version, the next poll starts it again from scratch
+        if index_dir is not None:
+            shutil.rmtree(index_dir, ignore_errors=True)
+    finally:
+        reload_lock.release()
+
+def read_manifest():
     try:
-        s3_client.download_file(INDEX_BUCKET, "docstore.json", INDEX_WRITE_LOCATION + "/docstore.json")
-        s3_client.download_file(INDEX_BUCKET, "index_store.json", INDEX_WRITE_LOCATION + "/index_store.json")
-        s3_client.download_file(INDEX_BUCKET, "vector_store.json", INDEX_WRITE_LOCATION + "/vector_store.json")
+        response = s3_client.get_object(Bucket=INDEX_BUCKET, Key=MANIFEST_KEY)
+        return json.loads(response['Body'].read().decode('utf-8'))
+    except s3_client.exceptions.NoSuchKey:
+        # indexes built before versioned publishing sit at the root of the bucket
+        return None
+
+def local_index_dir(manifest):
+    return INDEX_WRITE_LOCATION + "/" + (manifest["version"] if manifest else "unversioned")
+
+def download_index(manifest, index_dir):
+    if manifest is None:
+        prefix, files = "", INDEX_FILES
+    else:
+        prefix = manifest["prefix"]
+        for files in [LAZY_INDEX_FILES, QUANTIZED_INDEX_FILES, INDEX_FILES]:
+            if all(file in manifest["files"] for file in files):
+                break
+    if not os.path.exists(index_dir):
+        os.makedirs(index_dir)
+    for file in files:
+        s3_client.download_file(INDEX_BUCKET, prefix + file, index_dir + "/" + file)
+
+def remove_stale_index_versions(current_index_dir):
+    # the loaded engine holds everything in memory or open, removed files stay readable while they are open
+    for name in os.listdir(INDEX_WRITE_LOCATION):
+        index_dir = INDEX_WRITE_LOCATION + "/" + name
+        if index_dir != current_index_dir:
+            shutil.rmtree(index_dir, ignore_errors=True)
 
+def get_service_context():
+    global service_context
+    if service_context is None:
+        # define our LLM
+        llm_predictor = LLMPredictor(llm=CustomLLM())
+        embed_model = LangchainEmbedding(HuggingFaceEmbeddings(cache_folder="/tmp/HF_CACHE"))
+        service_context = ServiceContext.from_defaults(
+            llm_predictor=llm_predictor, prompt_helper=prompt_helper, embed_model=embed_model,
+        )
+    return service_context
+
+def load_query_engine(index_dir):
+    if os.path.exists(index_dir + "/" + QUANTIZED_VECTORS_FILE):
+        if os.path.exists(index_dir + "/" + NODE_STORE_FILE):
+            docstore = NodeTextStore(index_dir + "/" + NODE_STORE_FILE)
+        else:
+            docstore = SimpleDocumentStore.from_persist_path(index_dir + "/docstore.json")
+        retriever = QuantizedVectorRetriever(
+            docstore=docstore,
+            vectors=QuantizedVectors.load(index_dir),
+            service_context=get_service_context(),
+        )
+    else:
         # load index
-        storage_context = StorageContext.from_defaults(persist_dir=INDEX_WRITE_LOCATION)
-        index = load_index_from_storage(storage_context, service_context=service_context)
-        logger.info("Index successfully loaded")
-    except ClientError as e:
-        logger.error(e)
-        return "ERROR LOADING/READING INDEX"
+        storage_context = StorageContext.from_defaults(persist_dir=index_dir)
+        index = load_index_from_storage(storage_context, service_context=get_service_context())
 
-    retriever = VectorIndexRetriever(
-        service_context=service_context,
-        index=index,
-        similarity_top_k=5,
-        vector_store_query_mode=VectorStoreQueryMode.DEFAULT,  # doesn't work with simple
-        alpha=0.5,
-    )
+        retriever = VectorIndexRetriever(
+            service_context=get_service_context(),
+            index=index,
+            similarity_top_k=SIMILARITY_TOP_K,
+            vector_store_query_mode=VectorStoreQueryMode.DEFAULT,  # doesn't work with simple
+            alpha=0.5,
+        )
 
     # configure response synthesizer
     synth = ResponseSynthesizer.from_args(
         response_mode="simple_summarize",
-        service_context=service_context
+        service_context=get_service_context()
     )
 
-    query_engine = RetrieverQueryEngine(retriever=retriever, response_synthesizer=synth)
-    query_input = event["inputTranscript"]
+    return RetrieverQueryEngine(retriever=retriever, response_synthesizer=synth)
 
-    try:
-        answer = query_engine.query(query_input)
-        if answer.source_nodes[0].score < RETRIEVAL_THRESHOLD:
-            answer = OUT_OF_DOMAIN_RESPONSE
-    except:
-        answer = OUT_OF_DOMAIN_RESPONSE
+class QuantizedVectorRetriever(BaseRetriever):
+    """Searches the compact vectors published with the index instead of keeping full precision embeddings in memory."""
 
-    response = generate_lex_response(event, {}, "Fulfilled", answer)
-    jsonified_resp = json.loads(json.dumps(response, default=str))
-    return jsonified_resp
+    def __init__(self, docstore, vectors, service_context, similarity_top_k=SIMILARITY_TOP_K, shortlist_size=SHORTLIST_SIZE):
+        self._docstore = docstore
+        self._vectors = vectors
+        self._service_context = service_context
+        self._similarity_top_k = similarity_top_k
+        self._shortlist_size = shortlist_size
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        if query_bundle.embedding is None:
+            query_bundle.embedding = self._service_context.embed_model.get_agg_embedding_from_queries(
+                query_bundle.embedding_strs
+            )
+        results = self._vectors.search(query_bundle.embedding, self._similarity_top_k, self._shortlist_size)
+        return [NodeWithScore(node=self._docstore.get_node(node_id), score=score) for node_id, score in results]
+
+    def score_nodes(self, node_ids, query_embedding) -> List[NodeWithScore]:
+        """Exact scores for known nodes, ids missing from the loaded index version are skipped."""
+        results = self._vectors.score(node_ids, query_embedding)
+        return [NodeWithScore(node=self._docstore.get_node(node_id), score=score) for node_id, score in results]
 
 def generate_lex_response(intent_request, session_attributes, fulfillment_state, message):
     intent_request['sessionState']['intent']['state'] = fulfillment_state
@@ -173,4 +334,7 @@ def initialize_cache():
         os.mkdir("/tmp/TRANSFORMERS_CACHE")
 
     if not os.path.exists("/tmp/HF_CACHE"):
-        os.mkdir("/tmp/HF_CACHE")
\ No newline at end of file
+        os.mkdir("/tmp/HF_CACHE")
+
+    if not os.path.exists(INDEX_WRITE_LOCATION):
+        os.mkdir(INDEX_WRITE_LOCATION)
\ No newline at end of file
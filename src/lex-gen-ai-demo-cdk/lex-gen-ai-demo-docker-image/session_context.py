@@ -0,0 +1,128 @@
+# Per-session retrieval context carried between turns in a Lex session attribute, so follow up questions such as
+# "what about returns?" are answered with the previous question's topic without an extra LLM call.
+import base64
+import json
+import re
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+SESSION_CONTEXT_ATTRIBUTE = "faqContext"
+MAX_SESSION_CONTEXT_CHARS = 2048  # keeps the whole session state far below what lex accepts
+HISTORY_TURNS = 3
+MAX_HISTORY_QUERY_CHARS = 200
+FOLLOW_UP_MAX_WORDS = 6
+FOLLOW_UP_PREFIXES = ("what about", "how about", "and ", "what if", "same for", "also ")
+FOLLOW_UP_WORDS = {"it", "its", "that", "this", "those", "these", "they", "them", "their", "there"}
+DETERMINER_WORDS = {"that", "this", "those", "these"}  # "this store" names its topic, "how much is this" does not
+# words that carry no topic of their own, a pronoun question made only of these needs the previous turn to mean anything
+FILLER_WORDS = {
+    "what", "how", "when", "where", "why", "which", "who", "is", "are", "was", "were", "be", "do", "does", "did",
+    "can", "could", "will", "would", "should", "i", "you", "we", "me", "my", "your", "a", "an", "the", "to", "of",
+    "for", "in", "on", "with", "about", "much", "many", "long", "take", "cost", "costs", "mean", "work", "get",
+    "have", "has", "need", "again", "more", "tell", "explain", "s"
+}
+
+
+def encode_embedding(embedding: Sequence[float]) -> str:
+    # int8 with a single scale, 768 dimensions take about 1KB once base64 encoded
+    vector = np.asarray(embedding, dtype=np.float32)
+    scale = float(np.abs(vector).max()) / 127 or 1.0
+    codes = np.round(vector / scale).astype(np.int8)
+    return base64.b64encode(np.float32(scale).tobytes() + codes.tobytes()).decode("ascii")
+
+
+def decode_embedding(encoded: str) -> List[float]:
+    raw = base64.b64decode(encoded)
+    if len(raw) < 5:
+        raise ValueError("encoded embedding is too short")
+    scale = np.frombuffer(raw[:4], dtype=np.float32)[0]
+    return (np.frombuffer(raw[4:], dtype=np.int8).astype(np.float32) * scale).tolist()
+
+
+def load_session_context(session_attributes: Optional[dict]) -> Optional[dict]:
+    # clients can set session attributes, so anything that is not the shape save_session_context writes is dropped
+    # rather than failing the turn
+    if not session_attributes or SESSION_CONTEXT_ATTRIBUTE not in session_attributes:
+        return None
+    try:
+        context = json.loads(session_attributes[SESSION_CONTEXT_ATTRIBUTE])
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(context, dict):
+        return None
+
+    node_ids, history, embedding = context.get("node_ids"), context.get("history"), context.get("embedding")
+    if not isinstance(node_ids, list) or not all(isinstance(node_id, str) for node_id in node_ids):
+        return None
+    if not isinstance(history, list) or not all(isinstance(query, str) for query in history):
+        return None
+    if embedding is not None:
+        if not isinstance(embedding, str):
+            return None
+        try:
+            embedding = decode_embedding(embedding)
+        except ValueError:
+            return None
+    return {"node_ids": node_ids, "history": history, "embedding": embedding}
+
+
+def save_session_context(session_attributes: Optional[dict], node_ids: List[str],
+                         query_embedding: Optional[Sequence[float]], history: List[str]) -> dict:
+    context = {
+        "node_ids": node_ids,
+        "embedding": encode_embedding(query_embedding) if query_embedding is not None else None,
+        "history": [query[:MAX_HISTORY_QUERY_CHARS] for query in history[-HISTORY_TURNS:]]
+    }
+    serialized = json.dumps(context, separators=(",", ":"))
+    # drop the least useful parts first until the context fits
+    while len(serialized) > MAX_SESSION_CONTEXT_CHARS and context["history"]:
+        context["history"] = context["history"][1:]
+        serialized = json.dumps(context, separators=(",", ":"))
+    if len(serialized) > MAX_SESSION_CONTEXT_CHARS:
+        context["embedding"] = None
+        serialized = json.dumps(context, separators=(",", ":"))
+
+    session_attributes = dict(session_attributes or {})
+    session_attributes[SESSION_CONTEXT_ATTRIBUTE] = serialized
+    return session_attributes
+
+
+def is_follow_up(query: str) -> bool:
+    """A follow up opens with e.g. "what about", or is a short pronoun question with no topic of its own.
+
+    "How much does it cost?" is a follow up, "Is it free?" and "Where is this store located?" stand alone.
+    """
+    normalized = query.lower().strip()
+    if normalized.startswith(FOLLOW_UP_PREFIXES):
+        return True
+    words = re.findall(r"[a-z]+", normalized)
+    if len(words) > FOLLOW_UP_MAX_WORDS:
+        return False
+    refers_back = False
+    for position, word in enumerate(words):
+        next_word = words[position + 1] if position + 1 < len(words) else None
+        if word in FOLLOW_UP_WORDS and not (word in DETERMINER_WORDS and next_word and next_word not in FILLER_WORDS):
+            refers_back = True
+        elif word not in FILLER_WORDS and word not in FOLLOW_UP_WORDS:
+            return False
+    return refers_back
+
+
+def rewrite_query(query: str, history: List[str]) -> str:
+    """Prefix a follow up with the last question that stood on its own, e.g. "How long does shipping take? what about returns?"."""
+    standalone = [previous for previous in history if not is_follow_up(previous)]
+    previous_query = standalone[-1] if standalone else (history[-1] if history else None)
+    if previous_query is None:
+        return query
+    return f"{previous_query.rstrip()} {query.strip()}"
+
+
+def blend_embeddings(current: Sequence[float], previous: Sequence[float], previous_weight: float) -> List[float]:
+    current_vector = np.asarray(current, dtype=np.float32)
+    previous_vector = np.asarray(previous, dtype=np.float32)
+    if current_vector.shape != previous_vector.shape:
+        return list(current)
+    blended = (1 - previous_weight) * current_vector / (np.linalg.norm(current_vector) or 1) \
+        + previous_weight * previous_vector / (np.linalg.norm(previous_vector) or 1)
+    return blended.tolist()
@@ -0,0 +1,110 @@
+# Compact search vectors for the runtime retriever: embeddings are projected onto their top principal directions and
+# stored as int8, a shortlist is searched on those and re-ranked exactly against the full vectors memory mapped from disk.
+# The index creation and runtime images are built from separate docker contexts, so an identical copy of this file
+# lives in both index-creation-docker-image and lex-gen-ai-demo-docker-image. Keep them in sync.
+import os
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+QUANTIZED_VECTORS_FILE = "quantized_vectors.npz"
+FULL_VECTORS_FILE = "full_vectors.npy"
+PCA_FIT_SAMPLE_SIZE = 20000  # embeddings used to fit the projection, enough to find the principal directions
+SEARCH_BLOCK_SIZE = 8192  # rows dequantized at a time so a query never materializes every vector as float
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+class QuantizedVectors:
+    """Reduced and quantized copies of the node embeddings, searched with cosine similarity like SimpleVectorStore."""
+
+    def __init__(self, node_ids: List[str], codes: np.ndarray, scales: np.ndarray,
+                 projection: Optional[np.ndarray], full_vectors: np.ndarray):
+        self.node_ids = node_ids
+        self.codes = codes
+        self.scales = scales
+        self.projection = projection
+        self.full_vectors = full_vectors
+        self._positions = {node_id: position for position, node_id in enumerate(node_ids)}
+
+    @classmethod
+    def fit(cls, node_ids: List[str], embeddings: Sequence[Sequence[float]],
+            reduced_dimensions: Optional[int] = None, quantize: bool = True) -> "QuantizedVectors":
+        full_vectors = normalize_rows(np.asarray(embeddings, dtype=np.float32))
+
+        # not centered, so dot products in the reduced space approximate the original ones
+        projection = None
+        if reduced_dimensions is not None and reduced_dimensions < min(full_vectors.shape):
+            sample = full_vectors
+            if len(sample) > PCA_FIT_SAMPLE_SIZE:
+                sample = sample[np.random.default_rng(0).choice(len(sample), PCA_FIT_SAMPLE_SIZE, replace=False)]
+            _, _, components = np.linalg.svd(sample, full_matrices=False)
+            projection = components[:reduced_dimensions].T.astype(np.float32)
+        reduced = full_vectors @ projection if projection is not None else full_vectors
+
+        if quantize:
+            scales = np.abs(reduced).max(axis=0) / 127
+            scales[scales == 0] = 1
+            codes = np.round(reduced / scales).astype(np.int8)
+        else:
+            scales = np.ones(reduced.shape[1], dtype=np.float32)
+            codes = reduced
+        return cls(node_ids, codes, scales.astype(np.float32), projection, full_vectors)
+
+    def save(self, directory: str):
+        arrays = {"node_ids": np.array(self.node_ids), "codes": self.codes, "scales": self.scales}
+        if self.projection is not None:
+            arrays["projection"] = self.projection
+        np.savez(os.path.join(directory, QUANTIZED_VECTORS_FILE), **arrays)
+        np.save(os.path.join(directory, FULL_VECTORS_FILE), self.full_vectors)
+
+    @classmethod
+    def load(cls, directory: str) -> "QuantizedVectors":
+        with np.load(os.path.join(directory, QUANTIZED_VECTORS_FILE)) as arrays:
+            projection = arrays["projection"] if "projection" in arrays else None
+            quantized = cls(arrays["node_ids"].tolist(), arrays["codes"], arrays["scales"], projection,
+                            # only the rows of a shortlist are ever read back, leave the rest on disk
+                            np.load(os.path.join(directory, FULL_VECTORS_FILE), mmap_mode="r"))
+        return quantized
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes kept in memory to search, the full vectors are memory mapped and not counted."""
+        projection_bytes = self.projection.nbytes if self.projection is not None else 0
+        return self.codes.nbytes + self.scales.nbytes + projection_bytes
+
+    def _query_vector(self, query_embedding: Sequence[float]) -> np.ndarray:
+        query = np.asarray(query_embedding, dtype=np.float32)
+        return query / (np.linalg.norm(query) or 1)
+
+    def search(self, query_embedding: Sequence[float], top_k: int, shortlist_size: int) -> List[Tuple[str, float]]:
+        query = self._query_vector(query_embedding)
+        reduced_query = query @ self.projection if self.projection is not None else query
+        scaled_query = reduced_query * self.scales
+
+        approximate_scores = np.empty(len(self.node_ids), dtype=np.float32)
+        for start in range(0, len(self.node_ids), SEARCH_BLOCK_SIZE):
+            block = self.codes[start:start + SEARCH_BLOCK_SIZE].astype(np.float32)
+            approximate_scores[start:start + SEARCH_BLOCK_SIZE] = block @ scaled_query
+
+        shortlist_size = min(max(shortlist_size, top_k), len(self.node_ids))
+        if shortlist_size == 0:
+            return []
+        shortlist = np.argpartition(-approximate_scores, shortlist_size - 1)[:shortlist_size]
+        return self._rank(np.sort(shortlist), query, top_k)
+
+    def score(self, node_ids: List[str], query_embedding: Sequence[float]) -> List[Tuple[str, float]]:
+        """Exact cosine similarity of the given nodes, unknown ids are skipped."""
+        positions = sorted(self._positions[node_id] for node_id in node_ids if node_id in self._positions)
+        return self._rank(np.array(positions, dtype=np.int64), self._query_vector(query_embedding), len(positions))
+
+    def _rank(self, positions: np.ndarray, query: np.ndarray, top_k: int) -> List[Tuple[str, float]]:
+        if len(positions) == 0:
+            return []
+        exact_scores = np.asarray(self.full_vectors[positions]) @ query
+        order = np.argsort(-exact_scores)[:top_k]
+        return [(self.node_ids[positions[i]], float(exact_scores[i])) for i in order]
@@ -1,5 +1,5 @@
 from aws_cdk import (
-    Duration, App, Stack, CfnResource,
+    Duration, Size, App, Stack, CfnResource,
     aws_lex as lex,
     aws_s3 as s3,
     aws_s3_notifications as s3n,
@@ -28,8 +28,18 @@ class LexGenAIDemoFilesStack(Stack):
         lambda_cfn_role.add_managed_policy(iam.ManagedPolicy.from_aws_managed_policy_name("AmazonSageMakerFullAccess"))
         lambda_cfn_role.add_managed_policy(iam.ManagedPolicy.from_aws_managed_policy_name("AmazonS3FullAccess")) 
 
+        # index creation lambda fans bulk builds out to invocations of itself, arn is built from the name to avoid a circular dependency
+        index_function_name = "read-source-and-build-index-fn"
+        lambda_cfn_role.add_to_policy(
+            iam.PolicyStatement(
+                actions=["lambda:InvokeFunction"],
+                resources=[f"arn:aws:lambda:{self.region}:{self.account}:function:{index_function_name}"]
+            )
+        )
+
         # will append account id to this string to avoid in region collisions
         source_bucket_name = "lexgenaistack-source-materials-bucket-"
+        bulk_source_bucket_name = "lexgenaistack-bulk-source-materials-bucket-"
         index_bucket_name = "lexgenaistack-created-index-bucket-"
 
         # S3 Buckets for materials to index and for the resulting indexes
@@ -40,19 +50,35 @@ class LexGenAIDemoFilesStack(Stack):
                                   enforce_ssl=True,
                                   versioned=True)
         
+        # directory uploads go to their own bucket without an event notification, the uploader starts one build for the whole upload
+        s3.Bucket(self, "BulkSourceMatBucketID-CFN",
+                  bucket_name=bulk_source_bucket_name+lex_cfn_role.principal_account,
+                  block_public_access=s3.BlockPublicAccess.BLOCK_ALL,
+                  encryption=s3.BucketEncryption.S3_MANAGED,
+                  enforce_ssl=True,
+                  versioned=True)
+
         index_bucket = s3.Bucket(self, "IndexBucket-CFN", 
                                  bucket_name=index_bucket_name+lex_cfn_role.principal_account,
                                  block_public_access=s3.BlockPublicAccess.BLOCK_ALL,
                                  encryption=s3.BucketEncryption.S3_MANAGED,
                                  enforce_ssl=True,
-                                 versioned=True)
+                                 versioned=True,
+                                 lifecycle_rules=[
+                                     # partial indexes of fan-out builds that never merged, e.g. a worker that failed every retry
+                                     s3.LifecycleRule(prefix="partial-indexes/", expiration=Duration.days(7)),
+                                     # old index versions are deleted on publish, this removes the copies bucket versioning keeps
+                                     s3.LifecycleRule(noncurrent_version_expiration=Duration.days(7))
+                                 ])
 
         # create lambda image for on demand index creation
-        read_source_and_build_index_function = lambda_.DockerImageFunction(self, "read-source-and-build-index-function-CFN", function_name="read-source-and-build-index-fn",
+        read_source_and_build_index_function = lambda_.DockerImageFunction(self, "read-source-and-build-index-function-CFN", function_name=index_function_name,
             code=lambda_.DockerImageCode.from_image_asset("index-creation-docker-image"),
             role=lambda_cfn_role,
             memory_size=10240,
-            timeout=Duration.minutes(5)
+            timeout=Duration.minutes(15), # each shard worker and the merge of a bulk build get the full limit
+            # /tmp holds the embedding model, up to 16 partial indexes being merged and every file of the published version
+            ephemeral_storage_size=Size.gibibytes(10)
         )
         source_bucket.add_event_notification(s3.EventType.OBJECT_CREATED, s3n.LambdaDestination(read_source_and_build_index_function))
 
@@ -61,7 +87,9 @@ class LexGenAIDemoFilesStack(Stack):
             code=lambda_.DockerImageCode.from_image_asset("lex-gen-ai-demo-docker-image"),
             role=lambda_cfn_role,
             memory_size=10240,
-            timeout=Duration.minutes(5)
+            timeout=Duration.minutes(5),
+            # /tmp holds the embedding model and, while a new index version loads, both the old and the new version
+            ephemeral_storage_size=Size.gibibytes(4)
         )
         runtime_function.grant_invoke(iam.ServicePrincipal("lexv2.amazonaws.com"))
 
@@ -0,0 +1,106 @@
+import json
+import argparse
+from datetime import datetime
+
+from endpoint_capacity import SimulatedEndpoint, TARGET_INVOCATIONS_PER_INSTANCE
+
+# Replays recorded Lex traffic against a simulated endpoint to compare capacity policies before applying them.
+# Accepts Lex conversation logs exported from CloudWatch, either `aws logs filter-log-events` output or one
+# JSON record per line, e.g.
+#   python3 replay_lex_traffic.py conversation-logs.json --min-instances 1 --max-instances 3 --off-hours 20 8
+
+
+def parse_timestamp(value):
+    if isinstance(value, (int, float)):
+        return value / 1000 if value > 1e11 else value  # CloudWatch uses epoch milliseconds
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+
+
+def read_records(path):
+    with open(path) as f:
+        content = f.read()
+    try:
+        parsed = json.loads(content)
+        lines = parsed["events"] if isinstance(parsed, dict) and "events" in parsed else parsed
+        if isinstance(lines, dict):
+            lines = [lines]
+    except ValueError:
+        lines = [json.loads(line) for line in content.splitlines() if line.strip()]
+
+    for line in lines:
+        # CloudWatch log events wrap the Lex record in "message"
+        record = line
+        if isinstance(line.get("message"), str):
+            try:
+                record = json.loads(line["message"])
+            except ValueError:
+                record = {}
+        timestamp = line.get("timestamp", record.get("timestamp"))
+        if timestamp is not None:
+            yield parse_timestamp(timestamp), record
+
+
+def invocations_per_minute(paths, intent=None):
+    timestamps = []
+    for path in paths:
+        for timestamp, record in read_records(path):
+            if intent is None or record.get("sessionState", {}).get("intent", {}).get("name") == intent:
+                timestamps.append(timestamp)
+    if len(timestamps) == 0:
+        return None, []
+
+    start = int(min(timestamps) // 60 * 60)
+    counts = [0] * (int(max(timestamps) - start) // 60 + 1)
+    for timestamp in timestamps:
+        counts[int(timestamp - start) // 60] += 1
+    return start, counts
+
+
+def print_report(name, report, price_per_hour):
+    cost = f"${report['instance_minutes'] / 60 * price_per_hour:,.2f}" if price_per_hour else "-"
+    served = report['served'] / report['invocations'] if report['invocations'] else 1
+    print(f"{name:<22}{report['instance_minutes'] / 60:>16.1f}{cost:>12}{report['peak_instances']:>8}"
+          f"{report['scale_outs']:>8}{report['scale_ins']:>8}{report['rejected']:>10}{served:>10.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('logs', nargs='+', help='Exported Lex conversation log files.')
+    parser.add_argument('--intent', type=str, help='Only replay turns for this intent, e.g. FallbackIntent.', default=None)
+    parser.add_argument('--min-instances', type=int, help='At least 1, scale to zero is a manual action and is not replayed.', default=1)
+    parser.add_argument('--max-instances', type=int, default=2)
+    parser.add_argument('--target', type=int, help='Invocations per instance per minute to track.', default=TARGET_INVOCATIONS_PER_INSTANCE)
+    parser.add_argument('--capacity', type=int, help='Invocations one instance can serve per minute.', default=60)
+    parser.add_argument('--startup-minutes', type=int, help='Minutes before a new instance serves traffic.', default=8)
+    parser.add_argument('--off-hours', type=int, nargs=2, metavar=('START', 'END'),
+                        help='UTC hours of the weekday scale down and scale up, as in endpoint_capacity.py schedule.', default=None)
+    parser.add_argument('--off-hours-max-instances', type=int, default=1)
+    parser.add_argument('--price-per-hour', type=float, help='Instance price, to report cost.', default=None)
+    args = parser.parse_args()
+    if args.min_instances < 1:
+        parser.error("--min-instances must be at least 1")
+
+    start, counts = invocations_per_minute(args.logs, args.intent)
+    if len(counts) == 0:
+        print("[ERROR] No timestamped records found in the logs")
+        return
+    print(f"Replaying {sum(counts)} invocations over {len(counts)} minutes, peak {max(counts)} per minute")
+    print(f"{'policy':<22}{'instance hours':>16}{'cost':>12}{'peak':>8}{'outs':>8}{'ins':>8}{'rejected':>10}{'served':>10}")
+
+    fixed = SimulatedEndpoint(min_instances=1, max_instances=1, capacity_per_instance=args.capacity)
+    print_report("fixed 1 instance", fixed.replay(counts, start), args.price_per_hour)
+
+    policy = SimulatedEndpoint(
+        min_instances=args.min_instances,
+        max_instances=args.max_instances,
+        target_invocations_per_instance=args.target,
+        capacity_per_instance=args.capacity,
+        instance_startup_minutes=args.startup_minutes,
+        off_hours=tuple(args.off_hours) if args.off_hours else None,
+        off_hours_max_instances=args.off_hours_max_instances
+    )
+    print_report("autoscaling policy", policy.replay(counts, start), args.price_per_hour)
+
+
+if __name__ == "__main__":
+    main()
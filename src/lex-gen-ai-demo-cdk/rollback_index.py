@@ -0,0 +1,75 @@
+import sys
+import json
+import time
+import boto3
+from botocore.exceptions import ClientError
+import logging
+
+ACCOUNT_ID = boto3.client('sts').get_caller_identity().get('Account')
+INDEX_BUCKET = "lexgenaistack-created-index-bucket-"+ACCOUNT_ID
+# must match INDEX_VERSIONS_PREFIX and MANIFEST_KEY in index_creation_app.py
+INDEX_VERSIONS_PREFIX = "versions/"
+MANIFEST_KEY = "manifest.json"
+s3_client = boto3.client("s3")
+
+def main():
+    if len(sys.argv) == 1:
+        rollback()
+    elif len(sys.argv) == 2 and sys.argv[1] == "--list":
+        list_versions()
+    elif len(sys.argv) == 2:
+        rollback(sys.argv[1])
+    else:
+        print("[ERROR] Too many arguments, include nothing to roll back one version, a version to switch to, or --list")
+
+
+def read_manifest():
+    try:
+        response = s3_client.get_object(Bucket=INDEX_BUCKET, Key=MANIFEST_KEY)
+        return json.loads(response['Body'].read().decode('utf-8'))
+    except s3_client.exceptions.NoSuchKey:
+        return None
+
+
+def list_versions():
+    manifest = read_manifest()
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=INDEX_BUCKET, Prefix=INDEX_VERSIONS_PREFIX, Delimiter="/"):
+        for common_prefix in page.get('CommonPrefixes', []):
+            version = common_prefix['Prefix'][len(INDEX_VERSIONS_PREFIX):-1]
+            active = " (active)" if manifest and manifest["version"] == version else ""
+            print(version + active)
+
+
+# points the manifest at an already published version, runtime lambdas pick it up on their next manifest poll
+def rollback(version=None):
+    manifest = read_manifest()
+    if version is None:
+        if manifest is None or manifest.get("previous_version") is None:
+            print("[ERROR] No previous index version recorded in the manifest, pass a version to switch to")
+            return
+        version = manifest["previous_version"]
+
+    version_prefix = INDEX_VERSIONS_PREFIX + version + "/"
+    response = s3_client.list_objects_v2(Bucket=INDEX_BUCKET, Prefix=version_prefix)
+    files = [obj['Key'][len(version_prefix):] for obj in response.get('Contents', [])]
+    if len(files) == 0:
+        print(f"[ERROR] Index version {version} not found in {INDEX_BUCKET}")
+        return
+
+    new_manifest = {
+        "version": version,
+        "prefix": version_prefix,
+        "files": files,
+        "published_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "previous_version": manifest["version"] if manifest else None
+    }
+    try:
+        s3_client.put_object(Bucket=INDEX_BUCKET, Key=MANIFEST_KEY, Body=json.dumps(new_manifest), ContentType="application/json")
+        print(f"Index manifest now points at version {version}")
+    except ClientError as e:
+        logging.error(e)
+
+
+if __name__ == "__main__":
+    main()
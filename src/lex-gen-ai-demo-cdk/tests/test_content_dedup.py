@@ -0,0 +1,88 @@
+import filecmp
+import sys
+from pathlib import Path
+
+CDK_DIR = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(CDK_DIR / "index-creation-docker-image"))
+
+from content_dedup import (  # noqa: E402
+    DedupIndex,
+    EXACT_DUPLICATE,
+    NEAR_DUPLICATE,
+    drop_boilerplate_blocks,
+)
+
+RETURN_POLICY = (
+    "Items in the {category} category can be returned within {days} days of delivery for a full refund as long as "
+    "they are unused and in their original packaging. Refunds are issued to the original payment method within five "
+    "business days after the returned item is received and inspected at our warehouse."
+)
+FOOTER = (
+    "Copyright Example Inc. All rights reserved. Terms of use | Privacy policy | Contact us | Careers | "
+    "Accessibility statement | Site map | Follow us on social media for updates and offers"
+)
+
+
+def test_copies_in_both_images_are_identical():
+    assert filecmp.cmp(CDK_DIR / "index-creation-docker-image" / "content_dedup.py",
+                       CDK_DIR / "web-crawler-docker-image" / "content_dedup.py", shallow=False)
+
+
+def test_chunks_that_differ_in_a_fact_are_kept():
+    dedup_index = DedupIndex()
+    assert dedup_index.add(RETURN_POLICY.format(category="electronics", days=15)) is None
+    assert dedup_index.add(RETURN_POLICY.format(category="apparel", days=60)) is None
+    assert dedup_index.add(RETURN_POLICY.format(category="apparel", days=15)) is None
+    assert dedup_index.add(RETURN_POLICY.format(category="electronics", days=60)) is None
+    assert dedup_index.dropped == 0
+
+
+def test_exact_duplicates_ignore_case_and_whitespace():
+    dedup_index = DedupIndex()
+    text = RETURN_POLICY.format(category="electronics", days=15)
+    assert dedup_index.add(text) is None
+    assert dedup_index.add("  " + text.upper().replace(" ", "\n  ")) == EXACT_DUPLICATE
+
+
+def test_near_duplicate_that_adds_nothing_is_dropped():
+    dedup_index = DedupIndex()
+    assert dedup_index.add(FOOTER) is None
+    assert dedup_index.add(FOOTER.replace("Careers | ", "")) == NEAR_DUPLICATE
+    assert dedup_index.add(FOOTER + " today") is None
+
+
+def test_short_chunks_are_only_deduplicated_exactly():
+    dedup_index = DedupIndex()
+    assert dedup_index.add("Yes, within 30 days.") is None
+    assert dedup_index.add("Yes, within 60 days.") is None
+    assert dedup_index.add("Yes, within 30 days.") == EXACT_DUPLICATE
+
+
+def test_short_answers_repeated_on_a_page_are_kept():
+    page = "Q: Can I return?\n\nYes.\n\nQ: Can I exchange?\n\nYes."
+    pages, dropped = drop_boilerplate_blocks([page, page.replace("return", "cancel"), page.replace("return", "pay")])
+    assert dropped == 0
+    assert all(page.count("Yes.") == 2 for page in pages)
+
+
+def test_boilerplate_repeated_across_pages_is_kept_once():
+    pages = [f"{FOOTER}\n\nQuestion {number} and its answer" for number in range(3)]
+    kept_pages, dropped = drop_boilerplate_blocks(pages)
+    assert dropped == 2
+    assert kept_pages[0].startswith(FOOTER)
+    assert kept_pages[1:] == ["Question 1 and its answer", "Question 2 and its answer"]
+
+
+def test_blocks_on_fewer_pages_than_the_threshold_are_kept():
+    answer = RETURN_POLICY.format(category="electronics", days=15)
+    kept_pages, dropped = drop_boilerplate_blocks([answer, answer])
+    assert dropped == 0
+    assert kept_pages == [answer, answer]
+
+
+def test_signatures_persist_exact_hashes_only():
+    dedup_index = DedupIndex()
+    dedup_index.add(RETURN_POLICY.format(category="electronics", days=15))
+    signatures = dedup_index.to_dict()
+    assert list(signatures) == ["hashes"]
+    assert DedupIndex.from_dict(dict(signatures, simhashes=["ff"])).hashes == dedup_index.hashes
@@ -0,0 +1,45 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "lex-gen-ai-demo-docker-image"))
+
+from session_context import (  # noqa: E402
+    SESSION_CONTEXT_ATTRIBUTE,
+    is_follow_up,
+    load_session_context,
+    save_session_context,
+)
+
+
+@pytest.mark.parametrize("value", [
+    "[1,2]",
+    '"a string"',
+    "not json",
+    '{"node_ids": 5, "history": []}',
+    '{"node_ids": ["a"], "history": "question"}',
+    '{"node_ids": ["a"], "history": [], "embedding": 3}',
+    '{"node_ids": ["a"], "history": [], "embedding": "AAAA"}',
+])
+def test_malformed_context_is_dropped(value):
+    assert load_session_context({SESSION_CONTEXT_ATTRIBUTE: value}) is None
+
+
+def test_saved_context_round_trips():
+    session_attributes = save_session_context({"other": "kept"}, ["node"], [0.5, -0.25, 1.0], ["How long is shipping?"])
+    context = load_session_context(session_attributes)
+    assert session_attributes["other"] == "kept"
+    assert context["node_ids"] == ["node"]
+    assert context["history"] == ["How long is shipping?"]
+    assert context["embedding"] == pytest.approx([0.5, -0.25, 1.0], abs=0.01)
+
+
+@pytest.mark.parametrize("query", ["what about returns?", "How much does it cost?", "How long does that take?"])
+def test_follow_ups(query):
+    assert is_follow_up(query)
+
+
+@pytest.mark.parametrize("query", ["Where is this store located?", "Is it free?", "How long does shipping take?"])
+def test_standalone_questions(query):
+    assert not is_follow_up(query)
@@ -0,0 +1,17 @@
+import filecmp
+from pathlib import Path
+
+import pytest
+
+CDK_DIR = Path(__file__).resolve().parents[1]
+
+# modules copied into two docker contexts, the index writer and the runtime reader must agree on file formats
+SHARED_MODULES = [
+    ("vector_quantization.py", "index-creation-docker-image", "lex-gen-ai-demo-docker-image"),
+    ("node_text_store.py", "index-creation-docker-image", "lex-gen-ai-demo-docker-image"),
+]
+
+
+@pytest.mark.parametrize("module, first_image, second_image", SHARED_MODULES)
+def test_copies_are_identical(module, first_image, second_image):
+    assert filecmp.cmp(CDK_DIR / first_image / module, CDK_DIR / second_image / module, shallow=False)
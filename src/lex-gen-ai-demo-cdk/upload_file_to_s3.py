@@ -1,15 +1,35 @@
+import os
 import sys
+import json
+import time
 import boto3
+from boto3.exceptions import S3UploadFailedError
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import logging
 
 ACCOUNT_ID = boto3.client('sts').get_caller_identity().get('Account')
 S3_BUCKET = "lexgenaistack-source-materials-bucket-"+ACCOUNT_ID
+# directories go to a bucket without an event notification so each file does not start its own index build
+BULK_S3_BUCKET = "lexgenaistack-bulk-source-materials-bucket-"+ACCOUNT_ID
 s3_client = boto3.client("s3")
 
+# must match the index creation lambda's function name
+INDEX_FUNCTION_NAME = "read-source-and-build-index-fn"
+MAX_UPLOAD_WORKERS = 16
+
+# large files are split into parts that upload in parallel
+transfer_config = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=8,
+    use_threads=True
+)
+
 def main():
     if len(sys.argv) == 1:
-        print(f"[ERROR] You must specify file to upload")
+        print(f"[ERROR] You must specify file or directory to upload")
     elif len(sys.argv) == 2:
         filepath = sys.argv[1]
         upload(filepath)
@@ -17,21 +37,68 @@ def main():
         filepath = sys.argv[2]
         upload(filepath)
     else:
-        print("[ERROR] Too many arguments, only include /path/to/your/file")
+        print("[ERROR] Too many arguments, only include /path/to/your/file or /path/to/your/directory")
+
+
+def is_source_file(filepath):
+    return filepath[-4:].lower() == '.txt' or filepath[-4:].lower() == '.pdf'
 
 
 def upload(filepath):
-    if filepath[-4:].lower() == '.txt' or filepath[-4:].lower() == '.pdf':
+    if os.path.isdir(filepath):
+        upload_directory(filepath)
+    elif is_source_file(filepath):
         print(f"Uploading file at {filepath}")
         try:
             upload_name = filepath.split("/")[-1].replace(" ","").replace("/","")
-            s3_client.upload_file(filepath, S3_BUCKET, upload_name) 
+            s3_client.upload_file(filepath, S3_BUCKET, upload_name, Config=transfer_config)
             print(f"Successfully uploaded file at {filepath}, creating index...")
-        except ClientError as e:
+        except (S3UploadFailedError, ClientError, OSError) as e:
             logging.error(e)
     else:
         print("[ERROR] File must be txt or PDF")
 
 
+# uploads every txt and PDF file under directory to one prefix of the bulk bucket, then asks the index lambda to build a single index from it
+def upload_directory(directory):
+    filepaths = []
+    for root, _, files in os.walk(directory):
+        filepaths.extend(os.path.join(root, file) for file in files if is_source_file(file))
+    if len(filepaths) == 0:
+        print(f"[ERROR] No txt or PDF files found in {directory}")
+        return
+
+    prefix = time.strftime("%Y%m%d-%H%M%S") + "/"
+    print(f"Uploading {len(filepaths)} files from {directory} to {prefix}")
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=MAX_UPLOAD_WORKERS) as executor:
+        futures = {}
+        for filepath in filepaths:
+            upload_name = prefix + os.path.relpath(filepath, directory).replace(os.sep, "/").replace(" ","")
+            futures[executor.submit(s3_client.upload_file, filepath, BULK_S3_BUCKET, upload_name, Config=transfer_config)] = filepath
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except (S3UploadFailedError, ClientError, OSError) as e:
+                # the transfer manager wraps S3 errors in S3UploadFailedError, unreadable files raise OSError
+                failed += 1
+                logging.error(f"Failed to upload {futures[future]}: {e}")
+
+    if failed == len(filepaths):
+        print("[ERROR] No files were uploaded")
+        return
+    print(f"Successfully uploaded {len(filepaths) - failed} of {len(filepaths)} files, creating index...")
+
+    try:
+        boto3.client('lambda').invoke(
+            FunctionName=INDEX_FUNCTION_NAME,
+            InvocationType='Event',
+            Payload=json.dumps({"bucket": BULK_S3_BUCKET, "prefix": prefix})
+        )
+    except ClientError as e:
+        logging.error(e)
+
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
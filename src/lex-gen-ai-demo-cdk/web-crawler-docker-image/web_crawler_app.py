@@ -6,6 +6,7 @@ import re
 import logging
 import json
 import traceback
+from content_dedup import drop_boilerplate_blocks
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -70,6 +71,12 @@ class EZWebLoader:
         logging.info(f"Number of documents: {len(documents)}.")
         return documents
 
+def deduplicate_pages(documents: List[str]):
+    # headers, footers and navigation repeat on every page, keep them only on the first page they appear on
+    deduplicated, dropped = drop_boilerplate_blocks(documents)
+    logging.info(f"Dropped {dropped} repeated boilerplate blocks")
+    return deduplicated, dropped
+
 ACCOUNT_ID = boto3.client('sts').get_caller_identity().get('Account')
 S3_BUCKET = "lexgenaistack-source-materials-bucket-" + ACCOUNT_ID
 FILE_NAME = 'web-crawl-results.txt'
@@ -93,6 +100,7 @@ def handler(event, context):
         logger.info(f"Crawling {url} to depth of {depth}...")
         loader = EZWebLoader()
         documents = loader.load_data([url], depth, level_prefix)
+        documents, duplicate_blocks_dropped = deduplicate_pages(documents)
         doc_string = json.dumps(documents, indent=1)
         logger.info(f"Crawling {url} to depth of {depth} succeeded")
     except Exception as e:
@@ -113,7 +121,8 @@ def handler(event, context):
         logging.info(success_msg)
         return {
             "status": 200,
-            "message": success_msg
+            "message": success_msg,
+            "duplicate_blocks_dropped": duplicate_blocks_dropped
         }
     except Exception as e:
         # If there's an error, print the error message